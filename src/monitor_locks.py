@@ -1,16 +1,20 @@
 # monitor_locks.py
 
 import os
+import select
 import time
 import argparse
+from functools import lru_cache
 
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Connection, Engine
 from dotenv import load_dotenv
 
+_TRUE = frozenset({"1", "true", "yes", "y"})
+
+@lru_cache(maxsize=None)
 def env_bool(name: str, default: bool) -> bool:
-    val = os.getenv(name, str(default)).strip().lower()
-    return val in ("1","true","yes","y" )
+    return (os.environ.get(name) or ("1" if default else "0")).strip().lower() in _TRUE
 
 def get_env():
     load_dotenv()
@@ -22,20 +26,20 @@ def get_env():
 def mk_engine(url: str) -> Engine:
     return create_engine(url, pool_pre_ping=True, future=True)
 
-def print_lock_snapshot(engine: Engine):
+def print_lock_snapshot(con: Connection):
     sql = text("""
         SELECT locktype, mode, COUNT(*) AS cnt
         FROM pg_locks
         GROUP BY locktype, mode
         ORDER BY locktype, mode
     """)
-    with engine.connect() as con:
-        rows = con.execute(sql).all()
+    rows = con.execute(sql).all()
     print("Locks (by type/mode):")
     for lt, mode, cnt in rows:
         print(f"  {lt:>12} | {mode:<20} | {cnt}")
+    return rows
 
-def print_fastpath(engine: Engine):
+def print_fastpath(con: Connection):
     sql = text("""
         SELECT count(*) AS cnt, pid, mode, fastpath
         FROM pg_locks
@@ -43,13 +47,12 @@ def print_fastpath(engine: Engine):
         GROUP BY fastpath, mode, pid
         ORDER BY pid, mode
     """)
-    with engine.connect() as con:
-        rows = con.execute(sql).all()
+    rows = con.execute(sql).all()
     print("Fast-path vs regular locks (per PID):")
     for cnt, pid, mode, fast in rows[:20]:  # print top 20 to avoid noise
         print(f"  pid={pid} mode={mode:<20} fastpath={fast} cnt={cnt}")
 
-def list_blockers(engine: Engine):
+def list_blockers(con: Connection):
     sql = text("""
       SELECT
         now() - a.query_start AS query_age,
@@ -62,8 +65,7 @@ def list_blockers(engine: Engine):
       WHERE cardinality(pg_blocking_pids(a.pid)) > 0
       ORDER BY query_age DESC
     """)
-    with engine.connect() as con:
-        return con.execute(sql).all()
+    return con.execute(sql).all()
 
 def kill_blockers(engine: Engine):
     """Terminate all blocker PIDs (use only in a lab!)."""
@@ -78,30 +80,66 @@ def kill_blockers(engine: Engine):
     with engine.begin() as con:
         con.execute(sql)
 
+def parse_interval(s: str) -> float:
+    """Parse '2s', '500ms' or bare seconds; floor at 100ms."""
+    s = s.strip().lower()
+    if s.endswith("ms"):
+        return max(0.1, float(s[:-2]) / 1000.0)
+    if s.endswith("s"):
+        return max(0.1, float(s[:-1]))
+    return max(0.1, float(s))
+
+def listen(engine: Engine, channel: str):
+    """Open a dedicated autocommit DBAPI connection that LISTENs on channel.
+    The connection is detached from the pool, so the per-tick engine.connect()
+    never checks it out (and pre-ping/recycle never touch it) while we wait
+    on it. The wrapper is returned (and kept) for the listener's lifetime."""
+    listener = engine.raw_connection()
+    listener.detach()  # owned by the listener from here on, not returned to the pool
+    raw = listener.dbapi_connection
+    raw.autocommit = True  # notifications are only delivered outside a transaction
+    with raw.cursor() as cur:
+        cur.execute(f"LISTEN {engine.dialect.identifier_preparer.quote(channel)}")
+    return listener
+
+def wait_for_change(listen_conn, timeout: float) -> bool:
+    """Sleep up to timeout; with a LISTEN connection, wake early on NOTIFY.
+    Returns True if a notification arrived."""
+    if listen_conn is None:
+        time.sleep(timeout)
+        return False
+    raw = listen_conn.dbapi_connection
+    if not raw.notifies and not select.select([raw], [], [], timeout)[0]:
+        return False
+    raw.poll()
+    notified = bool(raw.notifies)
+    raw.notifies.clear()
+    return notified
+
 def main():
     cfg = get_env()
     parser = argparse.ArgumentParser(description="Monitor Postgres locks/blockers.")
     parser.add_argument("--every", default="2s", help="Refresh interval, e.g. 2s, 500ms.")
+    parser.add_argument("--max-every", help="Back off (doubling) up to this interval while nothing changes (default: --every, i.e. no backoff).")
+    parser.add_argument("--listen", metavar="CHANNEL", help="Also refresh immediately on NOTIFY CHANNEL (e.g. from a trigger or session).")
     args = parser.parse_args()
 
-    # Parse interval
-    interval = 2.0
-    s = args.every.strip().lower()
-    if s.endswith("ms"):
-        interval = max(0.1, float(s[:-2]) / 1000.0)
-    elif s.endswith("s"):
-        interval = max(0.1, float(s[:-1]))
-    else:
-        interval = max(0.1, float(s))
+    interval = parse_interval(args.every)
+    max_interval = max(interval, parse_interval(args.max_every)) if args.max_every else interval
 
     engine = mk_engine(cfg["DATABASE_URL"])
+    listen_conn = listen(engine, args.listen) if args.listen else None
 
+    sleep_for = interval
+    last_seen = None
     while True:
-        print("\n=== Lock snapshot ===")
-        print_lock_snapshot(engine)
-        print("\n=== Fast-path (sample) ===")
-        print_fastpath(engine)
-        blockers = list_blockers(engine)
+        # One pooled connection (and one pre-ping) per tick for all three queries.
+        with engine.connect() as con:
+            print("\n=== Lock snapshot ===")
+            locks = print_lock_snapshot(con)
+            print("\n=== Fast-path (sample) ===")
+            print_fastpath(con)
+            blockers = list_blockers(con)
         print(f"\n=== Blockers/Waiters ({len(blockers)}) ===")
         for row in blockers[:10]:
             qage, xage, pid, bpids, wait, snippet = row
@@ -115,7 +153,13 @@ def main():
             except Exception as e:
                 print("Kill failed:", repr(e))
 
-        time.sleep(interval)
+        # Scanning pg_locks isn't free under contention: poll at --every while
+        # things move and, with --max-every, back off exponentially while they don't.
+        seen = (tuple(map(tuple, locks)), tuple((b[2], tuple(b[3])) for b in blockers))
+        sleep_for = interval if seen != last_seen else min(max_interval, sleep_for * 2)
+        last_seen = seen
+        if wait_for_change(listen_conn, sleep_for):
+            sleep_for = interval
 
 if __name__ == "__main__":
     main()
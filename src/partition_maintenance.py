@@ -28,10 +28,12 @@ def create_week_from_days(engine: Engine, schema: str, week_start: datetime, com
     The *safe* flow is:
       1) CREATE TABLE week LIKE day INCLUDING ALL  (so constraints/replication defs carry over)
       2) DROP the day constraint on the copy; add a week-range CHECK constraint
-      3) INSERT ... SELECT from the 7 day partitions
+      3) INSERT ... SELECT the week's rows from the parent (pruned to the 7 day partitions),
+         with writes to those days blocked until COMMIT so no row is missed
       4) VALIDATE the new CHECK constraint
-      5) ATTACH PARTITION the new week table to the parent
-      6) (Optionally) DETACH the 7 day partitions
+      5) DETACH the day partitions (their range would overlap the week's)
+      6) ATTACH PARTITION the new week table to the parent
+    All in one transaction; the detached day tables are kept as plain tables.
 
     This is an *offline-ish* flow—on busy systems each step can contend on locks.
     In this lab we keep it simple and transparent.
@@ -47,31 +49,36 @@ def create_week_from_days(engine: Engine, schema: str, week_start: datetime, com
     """)
 
     # Drop the day CHECK on the copy (unknown name; search pg_constraint) and add week CHECK
-    drop_fmt = f"""
-    DO $$
-    DECLARE
-        cname text;
-    BEGIN
-        SELECT c.conname INTO cname
+    find_checks = text("""
+        SELECT c.conname
         FROM pg_constraint c
         JOIN pg_class t ON t.oid = c.conrelid
         JOIN pg_namespace n ON n.oid = t.relnamespace
-        WHERE n.nspname = '{schema}' AND t.relname = 'orders_{week_suffix}' AND c.contype='c';
-        IF cname IS NOT NULL THEN
-            EXECUTE format('ALTER TABLE {schema}.orders_{week_suffix} DROP CONSTRAINT %I', cname);
-        END IF;
-    END $$;
-    ALTER TABLE {schema}.orders_{week_suffix}
-      ADD CONSTRAINT orders_{week_suffix}_constraint
-      CHECK (order_time >= :lo AND order_time < :hi) NOT VALID;
-    """
+        WHERE n.nspname = :schema AND t.relname = :relname AND c.contype = 'c'
+    """)
+    add_check = text(f"""
+        ALTER TABLE {schema}.orders_{week_suffix}
+          ADD CONSTRAINT orders_{week_suffix}_constraint
+          CHECK (order_time >= :lo AND order_time < :hi) NOT VALID;
+    """)
 
-    # Insert from 7 days
-    inserts = []
-    for i in range(7):
-        day = (week_start + timedelta(days=i)).strftime("%Y_%m_%d")
-        inserts.append(f"INSERT INTO {schema}.orders_{week_suffix} SELECT * FROM {schema}.orders_{day};")
-    insert_sql = "\n".join(inserts)
+    # One partition-pruned scan of the parent instead of seven per-day INSERTs
+    # (also tolerates days in the window that have no partition).
+    insert_sql = text(f"""
+        INSERT INTO {schema}.orders_{week_suffix}
+        SELECT * FROM {schema}.orders
+        WHERE order_time >= :lo AND order_time < :hi;
+    """)
+
+    # Day partitions of this week that are still attached (named orders_YYYY_MM_DD).
+    attached_days = text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:parent AS regclass) AND c.relname = ANY(:names)
+        ORDER BY c.relname
+    """)
+    day_names = [f"orders_{(lo + timedelta(days=d)).strftime('%Y_%m_%d')}" for d in range(7)]
 
     validate_attach = text(f"""
         ALTER TABLE {schema}.orders_{week_suffix} VALIDATE CONSTRAINT orders_{week_suffix}_constraint;
@@ -81,13 +88,22 @@ def create_week_from_days(engine: Engine, schema: str, week_start: datetime, com
 
     with engine.begin() as con:
         con.execute(create_like)
-        con.execute(text(drop_fmt), {"lo": lo, "hi": hi})
-        con.execute(text(insert_sql))
-        con.execute(validate_attach)
+        quote = con.dialect.identifier_preparer.quote
+        for cname in con.execute(find_checks, {"schema": schema, "relname": f"orders_{week_suffix}"}).scalars().all():
+            con.execute(text(f"ALTER TABLE {schema}.orders_{week_suffix} DROP CONSTRAINT {quote(cname)}"))
+        con.execute(add_check, {"lo": lo, "hi": hi})
+        days = con.execute(attached_days, {"parent": f"{schema}.orders", "names": day_names}).scalars().all()
+        if days:
+            # EXCLUSIVE still allows reads but blocks writes to the days until COMMIT.
+            con.execute(text(f"LOCK TABLE {', '.join(f'{schema}.{d}' for d in days)} IN EXCLUSIVE MODE"))
+        con.execute(insert_sql, {"lo": lo, "hi": hi})
+        for d in days:
+            con.execute(text(f"ALTER TABLE {schema}.orders DETACH PARTITION {schema}.{d}"))
+        con.execute(validate_attach, {"lo": lo, "hi": hi})
 
     if commit:
         print(f"Created and attached week partition orders_{week_suffix} covering {lo}..{hi}.")
-        print("You may now DETACH the 7 day partitions if desired (see functions below)." )
+        print(f"Detached {len(days)} day partition(s) (kept as plain tables; drop them when done): {', '.join(days)}")
     else:
         print("(Dry run finished — but note we executed DDL/INSERT to make the example realistic.)")
 
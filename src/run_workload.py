@@ -1,12 +1,15 @@
 import os
 import random
+import re
+import threading
 import time
 import argparse
+from collections import Counter
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Connection, Engine
 from dotenv import load_dotenv
 
 
@@ -28,127 +31,221 @@ def get_env():
 def mk_engine(url: str, pool_size: int, max_overflow:int) -> Engine: 
     return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True, future=True)
 
-def rand_time(start: str, end: str) -> tuple[str, str]:
+_local = threading.local()
+
+def thread_rng() -> random.Random:
+    """
+    Per-thread RNG so pool workers don't contend on the shared
+    module-level `random` state.
     """
-    Picks a small random window within the global [start,end)
-    for range queries. 
+    rng = getattr(_local, "rng", None)
+    if rng is None:
+        rng = _local.rng = random.Random()
+    return rng
+
+def rand_time(s: datetime, e: datetime) -> tuple[datetime, datetime]:
+    """
+    Picks a small random window within the global [s,e)
+    for range queries. Bounds are parsed once by the caller.
     """
-    s = datetime.fromisoformat(start)
-    e = datetime.fromisoformat(end)
     span = (e - s).days
-    base = s + timedelta(days=random.randint(0, max(0, span-1)))
+    base = s + timedelta(days=thread_rng().randrange(max(1, span)))
     lo = base
     hi = base + timedelta(hours=6) # narrow window (fits one day partition)
-    return lo.isoformat(sep=' '), hi.isoformat(sep=' ')
+    return lo, hi
 
-def do_unbounded_range(engine: Engine, schema: str, start: str, end: str):
+# Each op's SQL (with :binds) and its bind parameters in order, with PG types
+# for PREPARE. {schema} is filled in once per run.
+OPS_SQL = dict(
+    unbounded_range=("SELECT count(*) FROM {schema}.orders WHERE amount > :min_amount",
+                     [("min_amount", "numeric")]),
+    pruned_range=("""
+        SELECT count(*)
+        FROM {schema}.orders
+        WHERE amount > :min_amount
+          AND order_time >= :lo AND order_time < :hi
+    """, [("min_amount", "numeric"), ("lo", "timestamp"), ("hi", "timestamp")]),
+    lookup_recent=("""
+        SELECT order_id FROM {schema}.orders
+        WHERE order_time > now() - interval '365 days'
+        ORDER BY order_time DESC
+        LIMIT 1
+    """, []),
+    lookup_row=("SELECT * FROM {schema}.orders WHERE order_id = :oid",
+                [("oid", "uuid")]),
+    update=("""
+        WITH candidate AS (
+            SELECT ctid FROM {schema}.orders
+            WHERE status IN ('new','in_progress')
+              AND order_time >= :lo AND order_time < :hi
+            ORDER BY order_time DESC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE {schema}.orders o
+        SET status = CASE status WHEN 'new' THEN 'in_progress' ELSE 'done' END,
+            updated_at = now()
+        WHERE o.ctid = (SELECT ctid FROM candidate)
+          AND o.order_time >= :lo AND o.order_time < :hi
+    """, [("lo", "timestamp"), ("hi", "timestamp")]),
+    insert=("""
+        INSERT INTO {schema}.orders(order_id, customer_id, store_id, status, amount, order_time, updated_at)
+        VALUES (gen_random_uuid(), floor(random()*100000)::int, floor(random()*500)::int, 'new', 42.00, now(), now())
+    """, []),
+)
+
+def statements(schema: str, prepared: bool = False) -> dict:
+    """
+    Build each op's text() once per run instead of on every call.
+    With prepared=True the statements EXECUTE the server-side prepared
+    versions created by prepare_on_connect(); bind names stay the same.
+    """
+    out = {}
+    for name, (sql, params) in OPS_SQL.items():
+        if prepared:
+            args = f"({', '.join(':' + p for p, _ in params)})" if params else ""
+            out[name] = text(f"EXECUTE wl_{name}{args}")
+        else:
+            out[name] = text(sql.format(schema=schema))
+    return out
+
+def prepare_on_connect(engine: Engine, schema: str):
+    """
+    PREPARE every op once per pooled connection, so each call is Bind/Execute
+    only (no parse/analyze). Note for the lab: after 5 runs Postgres may switch
+    to a generic plan, which on PG <= 15 locks *all* partitions at executor
+    start even when the query prunes to one.
+    """
+    prepares = []
+    for name, (sql, params) in OPS_SQL.items():
+        body = sql.format(schema=schema)
+        for i, (p, _) in enumerate(params, start=1):
+            body = re.sub(rf"(?<!:):{p}\b", f"${i}", body)
+        types = f"({', '.join(t for _, t in params)})" if params else ""
+        prepares.append(f"PREPARE wl_{name}{types} AS {body}")
+
+    @event.listens_for(engine, "connect")
+    def _prepare(dbapi_connection, connection_record):
+        with dbapi_connection.cursor() as cur:
+            for sql in prepares:
+                cur.execute(sql)
+        dbapi_connection.commit()
+
+# Every op takes (con, sql, start, end) so a worker can call any of them
+# the same way; ops that don't need the window ignore it. `sql` is the
+# dict from statements(); the worker owns the transaction.
+
+def do_unbounded_range(con: Connection, sql: dict, start: datetime, end: datetime):
     """
     This performs a range query which doesn't use an order_time filter.
     - This will likely create many locks 
     """
+    con.execute(sql["unbounded_range"], {"min_amount": 50})
 
-    sql = text(f"SELECT count(*) FROM {schema}.orders WHERE amount > :min_amount")
-    with engine.begin() as con:
-        con.execute(sql, {"min_amount": 50})
-
-def do_pruned_range(engine: Engine, schema: str, start: str, end: str):
+def do_pruned_range(con: Connection, sql: dict, start: datetime, end: datetime):
     """
     This targters a single partition via order_time
     """
     lo, hi = rand_time(start, end)
-    sql = text(f"""
-        SELECT count(*)
-        FROM {schema}.orders
-        WHERE amount > :min_amount
-          AND order_time >= :lo AND order_time < :hi
-    """)
-    with engine.begin() as con:
-        con.execute(sql, {"min_amount": 50, "lo": lo, "hi": hi})
+    con.execute(sql["pruned_range"], {"min_amount": 50, "lo": lo, "hi": hi})
 
-def do_lookup(engine: Engine, schema: str):
+def do_lookup(con: Connection, sql: dict, start: datetime, end: datetime):
     """
     Lookup the most recent order, then fetch its full row.
     """
-    sql = text(f"""
-        SELECT order_id FROM {schema}.orders
-        WHERE order_time > now() - interval '365 days'
-        ORDER BY order_time DESC
-        LIMIT 1
-    """)
-    with engine.begin() as con:
-        row = con.execute(sql).first()
-        # If we found an order_id, fetch its full row
-        if row:
-            oid = row[0]
-            con.execute(text(f"SELECT * FROM {schema}.orders WHERE order_id = :oid"), {"oid": str(oid)})
+    row = con.execute(sql["lookup_recent"]).first()
+    # If we found an order_id, fetch its full row
+    if row:
+        oid = row[0]
+        con.execute(sql["lookup_row"], {"oid": str(oid)})
 
-def do_update(engine: Engine, schema: str): 
+def do_update(con: Connection, sql: dict, start: datetime, end: datetime):
     """
     Flip some 'new' work to 'in_progress' or 'done'. Use LIMIT via
-    ctid (customer id) to avoid full-table update
+    ctid (customer id) to avoid full-table update.
+    The candidate row is claimed with SKIP LOCKED so concurrent workers pick
+    different rows instead of queueing on one, and the random order_time
+    window lets the planner prune to a single partition.
     """
-    sql = text(f"""
-        UPDATE {schema}.orders o
-        SET status = CASE status WHEN 'new' THEN 'in_progress' ELSE 'done' END,
-            updated_at = now()
-        WHERE ctid = (
-            SELECT ctid FROM {schema}.orders
-            WHERE status IN ('new','in_progress')
-            ORDER BY order_time DESC
-            LIMIT 1
-        )
-    """)
-    with engine.begin() as con:
-        con.execute(sql)
+    lo, hi = rand_time(start, end)
+    con.execute(sql["update"], {"lo": lo, "hi": hi})
 
-def do_insert(engine: Engine, schema: str):
+def do_insert(con: Connection, sql: dict, start: datetime, end: datetime):
     """
     Insert a tiny new order in the current time (routes to the newest partition).
     """
-    sql = text(f"""
-        INSERT INTO {schema}.orders(order_id, customer_id, store_id, status, amount, order_time, updated_at)
-        VALUES (gen_random_uuid(), floor(random()*100000)::int, floor(random()*500)::int, 'new', 42.00, now(), now())
-    """)
-    with engine.begin() as con:
-        con.execute(sql)
-
-def run_mode(engine: Engine, cfg: dict, mode: str, seconds: int = 20):
-    """Run a workload for some seconds using a thread pool."""
-    ops = {
-        "unbounded-range": do_unbounded_range,
-        "pruned-range": do_pruned_range,
-        "lookup": lambda eng, sch, *_: do_lookup(eng, sch),
-        "update": lambda eng, sch, *_: do_update(eng, sch),
-        "insert": lambda eng, sch, *_: do_insert(eng, sch),
-        "mixed": None,  # handled specially below
-    }
-
-    if mode != "mixed" and mode not in ops:
+    con.execute(sql["insert"])
+
+OPS = {
+    "unbounded-range": do_unbounded_range,
+    "pruned-range": do_pruned_range,
+    "lookup": do_lookup,
+    "update": do_update,
+    "insert": do_insert,
+}
+
+def pick_op(cfg: dict, mode: str, rng: random.Random):
+    """Return the op to run next for this mode."""
+    if mode != "mixed":
+        return OPS[mode]
+    r = rng.random()
+    if r < cfg["READ_RATIO"]:
+        return rng.choice([do_unbounded_range, do_pruned_range, do_lookup])
+    if r < cfg["READ_RATIO"] + cfg["UPDATE_RATIO"]:
+        return do_update
+    return do_insert
+
+def worker(engine: Engine, cfg: dict, mode: str, sql: dict,
+           start: datetime, end: datetime, stop_at: float) -> tuple[int, Counter]:
+    """
+    Run ops back to back on one pooled connection until stop_at, one
+    transaction per op. Returns the ok count and failures per exception type
+    (run_mode prints one summary instead of every worker printing per op).
+    """
+    rng = thread_rng()
+    ok = 0
+    failed: Counter = Counter()
+    with engine.connect() as con:
+        while time.time() < stop_at:
+            fn = pick_op(cfg, mode, rng)
+            try:
+                fn(con, sql, start, end)
+                con.commit()
+                ok += 1
+            except Exception as e:
+                # In a lab we count and continue; in prod you'd propagate or handle more carefully.
+                con.rollback()
+                # Keep the first line of the DB message (e.g. "no partition of relation ...").
+                detail = str(getattr(e, "orig", e)).strip().splitlines()
+                failed[f"{type(e).__name__}: {detail[0] if detail else ''}"] += 1
+    return ok, failed
+
+def run_mode(engine: Engine, cfg: dict, mode: str, seconds: int = 20, prepared: bool = False):
+    """
+    Run a workload for some seconds with CONCURRENCY long-lived workers,
+    so exactly CONCURRENCY sessions are busy for the whole run.
+    """
+    if mode != "mixed" and mode not in OPS:
         raise ValueError(f"Unknown mode: {mode}")
 
+    # Parse the data window and build the statements once, not on every op.
+    start = datetime.fromisoformat(cfg["START_DATE"])
+    end = datetime.fromisoformat(cfg["END_DATE"])
+    sql = statements(cfg["SCHEMA"], prepared)
+
     stop_at = time.time() + seconds
     with ThreadPoolExecutor(max_workers=cfg["CONCURRENCY"]) as tp:
-        futures = []
-        while time.time() < stop_at:
-            if mode == "mixed":
-                r = random.random()
-                if r < cfg["READ_RATIO"]:
-                    fn = random.choice([do_unbounded_range, do_pruned_range, do_lookup])
-                elif r < cfg["READ_RATIO"] + cfg["UPDATE_RATIO"]:
-                    fn = do_update
-                else:
-                    fn = do_insert
-            else:
-                fn = ops[mode]
-            futures.append(tp.submit(fn, engine, cfg["SCHEMA"], cfg["START_DATE"], cfg["END_DATE"]))
-
-        # Drain the queue (ignore individual failures in a lab)
+        futures = [tp.submit(worker, engine, cfg, mode, sql, start, end, stop_at)
+                   for _ in range(cfg["CONCURRENCY"])]
+        ok = 0
+        failed: Counter = Counter()
         for fut in as_completed(futures):
-            try:
-                fut.result()
-            except Exception as e:
-                # In a lab we log and continue; in prod you'd propagate or handle more carefully.
-                print("op failed:", repr(e))
+            n_ok, n_failed = fut.result()
+            ok += n_ok
+            failed += n_failed
+    print(f"{ok} op(s) ok, {sum(failed.values())} failed ({ok / max(1, seconds):.0f} ops/s).")
+    for reason, n in failed.most_common():
+        print(f"  {n:>8} x {reason}")
 
 def main():
     load_dotenv()
@@ -156,11 +253,19 @@ def main():
     parser = argparse.ArgumentParser(description="Run concurrent workloads to study locks.")
     parser.add_argument("--mode", required=True, choices=["unbounded-range","pruned-range","lookup","update","insert","mixed"], help="Workload shape to run.")
     parser.add_argument("--seconds", type=int, default=20, help="How long to run the workload.")
+    parser.add_argument("--prepared", action="store_true", help="Use server-side prepared statements (PREPARE once per connection).")
     args = parser.parse_args()
 
+    # Each worker holds one pooled connection for the whole run; extra workers
+    # would time out waiting for the pool and abort the run.
+    if cfg["CONCURRENCY"] > cfg["POOL_SIZE"] + cfg["MAX_OVERFLOW"]:
+        raise SystemExit(f"CONCURRENCY={cfg['CONCURRENCY']} exceeds POOL_SIZE + MAX_OVERFLOW "
+                         f"({cfg['POOL_SIZE']} + {cfg['MAX_OVERFLOW']}); raise the pool settings or lower CONCURRENCY.")
     engine = mk_engine(cfg["DATABASE_URL"], cfg["POOL_SIZE"], cfg["MAX_OVERFLOW"])
+    if args.prepared:
+        prepare_on_connect(engine, cfg["SCHEMA"])
     print(f"Running mode={args.mode} for {args.seconds}s with concurrency={cfg['CONCURRENCY']} ...")
-    run_mode(engine, cfg, args.mode, args.seconds)
+    run_mode(engine, cfg, args.mode, args.seconds, args.prepared)
     print("Done.")
 
 if __name__ == "__main__":